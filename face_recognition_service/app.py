@@ -5,179 +5,1178 @@ This service handles face enrollment and recognition for worker attendance
 """
 
 import os
+import hashlib
+import io
 import pickle
 import json
+import multiprocessing
+import queue
+import struct
+import threading
+import time
 import numpy as np
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Union
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import face_recognition
+import dlib
 from PIL import Image
 import cv2
 
+try:
+    import faiss  # Optional: approximate nearest-neighbour index for large enrollments
+except ImportError:
+    faiss = None
+
+try:
+    from numba import njit, prange  # Optional: fused single-pass distance kernel
+except ImportError:
+    njit = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB  # Optional: SIMD JPEG decoding with DCT scaling
+    _jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _jpeg = None
+
+try:
+    from waitress import serve  # Production WSGI server with HTTP keep-alive
+except ImportError:
+    serve = None
+
+try:
+    from flask_compress import Compress  # Optional: gzip JSON responses
+except ImportError:
+    Compress = None
+
+# dlib models, loaded once per process when face_recognition is imported;
+# used directly to skip the face_recognition wrappers on the hot path
+_detector = face_recognition.api.face_detector
+_sp_5pt = face_recognition.api.pose_predictor_5_point
+_encoder = face_recognition.api.face_encoder
+
+# dlib built with CUDA runs the CNN detector and the encoder on the GPU
+_HAS_CUDA = bool(getattr(dlib, 'DLIB_USE_CUDA', False))
+
+# On a CUDA build every detection process, CPU pool included, creates its
+# own CUDA context and copy of the dlib models on the GPU (a few hundred MB
+# each), so a pool of cpu_count() processes can exhaust GPU memory
+_DEFAULT_DETECTION_WORKERS = min(os.cpu_count() or 1, 2) if _HAS_CUDA else (os.cpu_count() or 1)
+
+# Concurrency comes from the request threads and the detection pool, so keep
+# OpenCV from spawning its own thread team per call
+cv2.setNumThreads(1)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+if Compress is not None:
+    Compress(app)  # Compress responses for clients that accept gzip
 
 # Configuration
 CONFIG = {
-    'KNOWN_FACES_FILE': 'known_faces.dat',
+    'KNOWN_MATRIX_FILE': 'known_matrix.bin',  # (N, 128) float32 encodings
+    'KNOWN_IDS_FILE': 'known_ids.bin',  # (N,) int32 worker ids
+    'KNOWN_UIDS_FILE': 'known_uids.bin',  # (N,) int64 stable face ids
+    'KNOWN_METADATA_FILE': 'known_metadata.json',
+    'LEGACY_FACES_FILE': 'known_faces.dat',  # Pickle store, migrated on first load
     'KNOWN_FACES_DIR': 'known_faces',
-    'TEMP_DIR': 'temp_images',
     'FACE_MATCH_THRESHOLD': 0.6,  # Lower = more strict, Higher = more lenient
     'MAX_FACES_PER_WORKER': 10,
     'IMAGE_SIZE': (500, 500),  # Resize images for consistency
+    'ENROLL_JITTERS': 1,  # Re-samples per face when enrolling (recognition uses 0)
+    'NUMBA_MIN_FACES': 10000,  # Use the Numba kernel (if installed) from this many faces up
+    'NORM_PREFILTER': False,  # Only compare rows whose norm is within the match radius (1 - threshold) of the query's
+    'ANN_MIN_FACES': 1000,  # Use the FAISS HNSW index (if installed) from this many faces up; after a delete it is rebuilt in the background and matching falls back to the exact scan meanwhile
+    'HNSW_M': 32,  # Neighbours per node in the HNSW graph
+    'DETECTION_WORKERS': int(os.environ.get('FACE_DETECTION_WORKERS', _DEFAULT_DETECTION_WORKERS)),  # Processes running single-image HOG detection/encoding; cpu_count(), or 2 on CUDA builds
+    'GPU_DETECTION_WORKERS': int(os.environ.get('FACE_GPU_DETECTION_WORKERS', 1)),  # Processes running batched CNN jobs on the GPU (CUDA only)
+    'DETECTOR': 'cnn' if _HAS_CUDA else 'hog',  # Detector for batched jobs: /enroll_batch, and /recognize with RECOGNIZE_BATCHING; single-image calls use HOG
+    'CNN_BATCH_SIZE': 32,  # Images per CNN detector call
+    'DETECTION_TIMEOUT': 10,  # Seconds to wait for a detection job
+    'FRAME_CACHE_TTL': 2.0,  # Seconds a recognition result is reused for a byte-identical re-upload
+    'FRAME_CACHE_SIZE': 1024,  # Max cached uploads
+    'SERVER_THREADS': 8,  # Request threads in the WSGI server
+    'SERVER_CONNECTION_LIMIT': 256,  # Max open (keep-alive) client connections
+    'RECOGNIZE_BATCHING': False,  # Group concurrent /recognize calls into one batched encode + match
+    'RECOGNIZE_BATCH_SIZE': 16,  # Max images per batch
+    'RECOGNIZE_BATCH_WAIT': 0.01,  # Seconds to wait for more images before running a batch
 }
 
-# Global variables to store face data in memory
-known_face_encodings: List[np.ndarray] = []
+# On-disk store files: a fixed header followed by raw little-endian rows.
+# Row i of every file describes the same face, matching row i in memory.
+# The uids store's header also records the next face id to hand out, so
+# ids stay unique across restarts without rewriting any other file.
+STORE_HEADER = struct.Struct('<4sIQQ')  # magic, bytes per row, row count, next face id (uids store only)
+MATRIX_MAGIC = b'LFEM'
+IDS_MAGIC = b'LFEI'
+UIDS_MAGIC = b'LFEU'
+DELETED_ID = -1  # Worker id written over a row while it is being removed
+
+# Global variables to store face data in memory. known_matrix holds one
+# float32 encoding per row and starts as a read-only memmap of the store;
+# known_face_ids[i] is the worker owning row i and known_face_uids[i] its
+# stable face id. Rows move when others are deleted, face ids never do.
+known_matrix: np.ndarray = np.empty((0, 128), dtype=np.float32)
 known_face_ids: List[int] = []
+known_face_uids: List[int] = []
 known_face_metadata: Dict[int, Dict] = {}  # worker_id -> metadata
+next_face_uid = 0
+store_writable = False  # Set once the store loaded; a failed load must not be appended to
+
+# Rows of known_matrix per worker, kept in sync with known_face_ids
+worker_to_indices: Dict[int, List[int]] = defaultdict(list)
+worker_counts: Counter = Counter()
+
+# Growable buffers backing known_matrix and known_sq_norms once they have
+# been modified in memory
+_matrix_buffer: Optional[np.ndarray] = None
+_sq_norms_buffer: Optional[np.ndarray] = None
+
+# Matching caches derived from known_matrix by _rebuild_match_cache()
+known_sq_norms: np.ndarray = np.empty((0,), dtype=np.float32)  # ||K_i||^2 per row
+
+# Rows sorted by ||K_i||, for the norm prefilter: known_sorted_norms[j] is
+# the norm of row known_norm_order[j]. Only kept while NORM_PREFILTER is on;
+# None until the first prefiltered query sorts the rows.
+known_norm_order: Optional[np.ndarray] = None
+known_sorted_norms: Optional[np.ndarray] = None
+
+# FAISS HNSW index over known_matrix; labels are row positions. None when
+# FAISS is unavailable, there are too few faces for the index to pay off,
+# or it is being rebuilt after rows moved. The generation is bumped every
+# time rows move, so a background build started before that is discarded.
+faiss_index = None
+_index_generation = 0
+_index_building = False  # A build for the current generation is running
+
+# Process pool running detect_and_encode_faces, started in main(). When it
+# is None (e.g. the app is imported by another server) work runs inline.
+# With CUDA, batched CNN jobs go to their own small pool so the GPU is not
+# shared by every CPU worker; with a CUDA build of dlib the CPU workers
+# still run the encoder on the GPU, each with its own CUDA context, which
+# is why DETECTION_WORKERS defaults to 2 there.
+executor: Optional[ProcessPoolExecutor] = None
+gpu_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()  # Serializes replacing a crashed pool
+
+# Recent /recognize hits keyed by a digest of the exact upload bytes:
+# digest -> (monotonic time, worker_id, confidence, face_location).
+# Only byte-identical uploads (client retries, double submits) may reuse an
+# identity; a perceptual hash of the frame is dominated by the kiosk
+# background and collides between different people at the same camera.
+# The generation is bumped on every clear so results computed before a
+# delete or threshold change are not cached after it.
+_frame_cache: 'OrderedDict[bytes, Tuple[float, int, float, Optional[Tuple]]]' = OrderedDict()
+_frame_cache_generation = 0
+
+# Guards the face data, match caches, index and frame cache above. Routes
+# hold it across check-then-act sequences so concurrent request threads
+# never see a half-applied enrollment or delete; it is reentrant so the
+# helpers below can take it again.
+_lock = threading.RLock()
+
+# Micro-batcher for /recognize: handlers queue (image_data, Future) pairs
+# and a background thread started on first use resolves them in batches
+_recognize_queue: 'queue.Queue[Tuple[bytes, Future]]' = queue.Queue()
+_batcher_thread: Optional[threading.Thread] = None
+_batcher_lock = threading.Lock()
 
 def init_directories():
     """Create necessary directories if they don't exist"""
     os.makedirs(CONFIG['KNOWN_FACES_DIR'], exist_ok=True)
-    os.makedirs(CONFIG['TEMP_DIR'], exist_ok=True)
+
+def _rebuild_index(appended_only: bool = False):
+    """
+    Keep the FAISS index in sync with known_matrix. Appended rows are added
+    to the existing graph. HNSW cannot remove points, so once rows have
+    moved (deletes, reloads) the graph is rebuilt in a background thread
+    instead of under _lock; queries use the exact scan until it is ready.
+    """
+    global faiss_index, _index_generation, _index_building
+    
+    if faiss is None or len(known_matrix) < CONFIG['ANN_MIN_FACES']:
+        faiss_index = None
+        _index_generation += 1
+        _index_building = False
+        return
+    
+    if appended_only and faiss_index is not None:
+        faiss_index.add(known_matrix[faiss_index.ntotal:])
+        return
+    
+    if appended_only and _index_building:
+        return  # The running build picks up the new rows when it installs
+    
+    faiss_index = None
+    _index_generation += 1
+    _index_building = True
+    threading.Thread(
+        target=_build_index,
+        args=(_index_generation, known_matrix),
+        name='hnsw-build',
+        daemon=True
+    ).start()
+
+def _build_index(generation: int, rows: np.ndarray):
+    """
+    Build an HNSW graph over a snapshot of known_matrix outside _lock, then
+    install it unless rows moved in the meantime. Rows appended during the
+    build are added at install time.
+    """
+    global faiss_index, _index_building
+    
+    try:
+        index = faiss.IndexHNSWFlat(rows.shape[1], CONFIG['HNSW_M'])
+        index.add(np.ascontiguousarray(rows))
+    except Exception as e:
+        print(f"❌ Error building ANN index: {e}")
+        index = None
+    
+    with _lock:
+        if generation != _index_generation:
+            return  # Superseded by a newer build
+        
+        _index_building = False
+        if index is None:
+            return
+        
+        if index.ntotal < len(known_matrix):
+            index.add(known_matrix[index.ntotal:])
+        faiss_index = index
+
+def _rebuild_match_cache(appended_only: bool = False):
+    """
+    Refresh the squared norms and FAISS index derived from known_matrix.
+    When rows were only appended, only the new rows are processed.
+    """
+    global known_sq_norms, _sq_norms_buffer
+    
+    start = len(known_sq_norms) if appended_only and len(known_sq_norms) <= len(known_matrix) else 0
+    end = len(known_matrix)
+    new_rows = known_matrix[start:]
+    
+    _sq_norms_buffer = _grown(_sq_norms_buffer, known_sq_norms[:start], end - start)
+    _sq_norms_buffer[start:end] = np.einsum('ij,ij->i', new_rows, new_rows)
+    known_sq_norms = _sq_norms_buffer[:end]
+    
+    _update_norm_order(start)
+    _rebuild_index(appended_only)
+
+def _rebuild_norm_order():
+    """Sort all rows by norm (O(N log N), done lazily by the prefilter)"""
+    global known_norm_order, known_sorted_norms
+    
+    norms = np.sqrt(known_sq_norms)
+    known_norm_order = np.argsort(norms, kind='stable')
+    known_sorted_norms = norms[known_norm_order]
+
+def _update_norm_order(start: int):
+    """
+    Merge rows start.. of known_sq_norms into the norm-sorted order, O(k log N)
+    plus one O(N) copy. When the prefilter is off, or the order does not cover
+    exactly the rows before start, it is dropped instead.
+    """
+    global known_norm_order, known_sorted_norms
+    
+    if not CONFIG['NORM_PREFILTER'] or known_norm_order is None or len(known_norm_order) != start:
+        known_norm_order = None
+        known_sorted_norms = None
+        return
+    
+    new_norms = np.sqrt(known_sq_norms[start:])
+    order = np.argsort(new_norms, kind='stable')
+    positions = np.searchsorted(known_sorted_norms, new_norms[order], side='right')
+    known_sorted_norms = np.insert(known_sorted_norms, positions, new_norms[order])
+    known_norm_order = np.insert(known_norm_order, positions, start + order)
+
+def count_known_faces() -> int:
+    """Number of enrolled face encodings"""
+    return len(known_face_ids)
+
+def count_known_workers() -> int:
+    """Number of workers with at least one face encoding"""
+    return len(worker_counts)
+
+def _rebuild_worker_index():
+    """Rebuild worker_to_indices and worker_counts from known_face_ids"""
+    worker_to_indices.clear()
+    for index, worker_id in enumerate(known_face_ids):
+        worker_to_indices[worker_id].append(index)
+    
+    worker_counts.clear()
+    worker_counts.update({worker_id: len(indices) for worker_id, indices in worker_to_indices.items()})
+
+def _read_store(path: str, magic: bytes, dtype, row_shape: Tuple) -> Optional[np.ndarray]:
+    """Memory-map the rows of a store file, or return None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape))
+    with open(path, 'rb') as f:
+        file_magic, file_row_bytes, count, _ = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+    
+    if file_magic != magic or file_row_bytes != row_bytes:
+        raise ValueError(f"{path} is not a valid face store file")
+    
+    if count == 0:
+        return np.empty((0,) + row_shape, dtype=dtype)
+    
+    return np.memmap(path, dtype=dtype, mode='r', offset=STORE_HEADER.size, shape=(count,) + row_shape)
+
+def _read_store_next_id(path: str) -> int:
+    """Next face id recorded in a store header (0 if none was recorded)"""
+    with open(path, 'rb') as f:
+        return STORE_HEADER.unpack(f.read(STORE_HEADER.size))[3]
+
+def _write_store(path: str, magic: bytes, rows: np.ndarray, next_id: int = 0):
+    """
+    Rewrite a store file from scratch via a temporary sibling, so readers
+    (and live memmaps of the old file) never see it half-written
+    """
+    rows = np.ascontiguousarray(rows)
+    row_bytes = rows.itemsize * int(np.prod(rows.shape[1:]))
+    
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(STORE_HEADER.pack(magic, row_bytes, len(rows), next_id))
+        f.write(rows.tobytes())
+    os.replace(tmp_path, path)
+
+def _append_store(path: str, magic: bytes, rows: np.ndarray, next_id: int = 0):
+    """
+    Append rows to a store file. The row count (and next face id) in the
+    header are only bumped after the rows are written, in one header write,
+    so a crash mid-append leaves the file valid.
+    """
+    if not os.path.exists(path):
+        _write_store(path, magic, rows, next_id)
+        return
+    
+    rows = np.ascontiguousarray(rows)
+    row_bytes = rows.itemsize * int(np.prod(rows.shape[1:]))
+    
+    with open(path, 'r+b') as f:
+        _, _, count, _ = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+        f.seek(STORE_HEADER.size + count * row_bytes)
+        f.write(rows.tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(STORE_HEADER.pack(magic, row_bytes, count + len(rows), next_id))
+
+def _overwrite_store_row(path: str, index: int, row: np.ndarray):
+    """Overwrite a single row of a store file in place"""
+    data = np.ascontiguousarray(row).tobytes()
+    with open(path, 'r+b') as f:
+        f.seek(STORE_HEADER.size + index * len(data))
+        f.write(data)
+
+def _truncate_store(path: str, count: int):
+    """Drop rows past count by rewriting the header's row count"""
+    with open(path, 'r+b') as f:
+        magic, row_bytes, _, next_id = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+        f.seek(0)
+        f.write(STORE_HEADER.pack(magic, row_bytes, count, next_id))
+
+def _grown(buffer: Optional[np.ndarray], rows: np.ndarray, extra_rows: int) -> np.ndarray:
+    """
+    Return buffer if rows is a view of it with room for extra_rows more,
+    otherwise a new buffer starting with a copy of rows. Capacity grows
+    geometrically so appends are amortized O(1).
+    """
+    count = len(rows)
+    if buffer is not None and rows.base is buffer and count + extra_rows <= len(buffer):
+        return buffer
+    
+    grown = np.empty((max(2 * count, count + extra_rows, 64),) + rows.shape[1:], dtype=rows.dtype)
+    grown[:count] = rows
+    return grown
+
+def _ensure_matrix_capacity(extra_rows: int):
+    """
+    Make known_matrix a writable view over _matrix_buffer with room for
+    extra_rows more rows
+    """
+    global known_matrix, _matrix_buffer
+    
+    _matrix_buffer = _grown(_matrix_buffer, known_matrix, extra_rows)
+    known_matrix = _matrix_buffer[:len(known_matrix)]
+
+def _check_store_writable():
+    """Refuse to modify store files that load_known_faces could not read"""
+    if not store_writable:
+        raise RuntimeError('Known faces store failed to load; not modifying it (see startup log)')
+
+def _append_faces(encodings: List[np.ndarray], worker_id: int) -> List[int]:
+    """
+    Append encodings for a worker in memory and to the on-disk store
+    Returns: the new face ids
+    """
+    global known_matrix, next_face_uid
+    
+    with _lock:
+        _check_store_writable()
+        rows = np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+        count = len(known_matrix)
+        uids = list(range(next_face_uid, next_face_uid + len(rows)))
+        next_face_uid += len(rows)
+        
+        _ensure_matrix_capacity(len(rows))
+        _matrix_buffer[count:count + len(rows)] = rows
+        known_matrix = _matrix_buffer[:count + len(rows)]
+        known_face_ids.extend([worker_id] * len(rows))
+        known_face_uids.extend(uids)
+        worker_to_indices[worker_id].extend(range(count, count + len(rows)))
+        worker_counts[worker_id] += len(rows)
+        _rebuild_match_cache(appended_only=True)
+        
+        # Matrix first: on load the shortest file wins
+        _append_store(CONFIG['KNOWN_MATRIX_FILE'], MATRIX_MAGIC, rows)
+        _append_store(CONFIG['KNOWN_UIDS_FILE'], UIDS_MAGIC, np.asarray(uids, dtype=np.int64), next_face_uid)
+        _append_store(CONFIG['KNOWN_IDS_FILE'], IDS_MAGIC, np.full(len(rows), worker_id, dtype=np.int32))
+        
+        return uids
+
+def _swap_remove(index: int):
+    """
+    Remove row index by moving the last row into its place, in memory and
+    on disk. The row is first marked DELETED_ID on disk so an interrupted
+    swap leaves a dead row for load_known_faces to drop, never a face
+    attributed to the wrong worker.
+    """
+    global known_matrix, known_sq_norms
+    
+    last = len(known_face_ids) - 1
+    _overwrite_store_row(CONFIG['KNOWN_IDS_FILE'], index, np.int32(DELETED_ID))
+    
+    if index != last:
+        moved_worker = known_face_ids[last]
+        known_matrix[index] = known_matrix[last]
+        known_face_ids[index] = moved_worker
+        known_face_uids[index] = known_face_uids[last]
+        known_sq_norms[index] = known_sq_norms[last]
+        
+        moved_rows = worker_to_indices[moved_worker]
+        moved_rows[moved_rows.index(last)] = index
+        
+        _overwrite_store_row(CONFIG['KNOWN_MATRIX_FILE'], index, known_matrix[index])
+        _overwrite_store_row(CONFIG['KNOWN_UIDS_FILE'], index, np.int64(known_face_uids[index]))
+        _overwrite_store_row(CONFIG['KNOWN_IDS_FILE'], index, np.int32(moved_worker))
+    
+    known_face_ids.pop()
+    known_face_uids.pop()
+    known_matrix = known_matrix[:last]
+    known_sq_norms = known_sq_norms[:last]
+    
+    for path in (CONFIG['KNOWN_MATRIX_FILE'], CONFIG['KNOWN_UIDS_FILE'], CONFIG['KNOWN_IDS_FILE']):
+        _truncate_store(path, last)
+
+def _remove_worker_faces(worker_id: int) -> int:
+    """
+    Remove all faces of a worker in memory and on disk, O(k) in their number
+    Returns: number of faces removed
+    """
+    global known_norm_order, known_sorted_norms
+    
+    with _lock:
+        _check_store_writable()
+        indices = worker_to_indices.pop(worker_id, [])
+        worker_counts.pop(worker_id, None)
+        if not indices:
+            return 0
+        
+        _ensure_matrix_capacity(0)
+        
+        # Highest rows first, so the row swapped in from the end is never one
+        # that still has to be removed
+        for index in sorted(indices, reverse=True):
+            _swap_remove(index)
+        
+        # Rows moved; the prefilter re-sorts on its next query
+        known_norm_order = None
+        known_sorted_norms = None
+        
+        _rebuild_index()
+        return len(indices)
+
+def _load_legacy_faces(legacy_file: str):
+    """Read the old pickle store (list of float64 arrays) into memory"""
+    global known_matrix, known_face_ids, known_face_uids, known_face_metadata
+    
+    with open(legacy_file, 'rb') as f:
+        data = pickle.load(f)
+    
+    encodings = data['encodings']
+    known_matrix = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), 128)
+    known_face_ids = [int(wid) for wid in data['ids']]
+    known_face_uids = list(range(len(known_face_ids)))
+    known_face_metadata = data.get('metadata', {})
+
+def _repair_store() -> bool:
+    """
+    Undo the traces of an interrupted delete: a duplicated last row (moved
+    but not yet truncated) and rows still marked DELETED_ID
+    Returns: True if anything was dropped
+    """
+    global known_matrix, known_face_ids, known_face_uids
+    
+    if not known_face_ids:
+        return False
+    
+    keep = np.asarray(known_face_ids, dtype=np.int64) != DELETED_ID
+    
+    # Only a live row counts as the moved copy: if the swap stopped before
+    # the id was rewritten, the copy is still DELETED_ID and the last row
+    # is the only one left of that face
+    live_uids = {uid for uid, kept in zip(known_face_uids[:-1], keep[:-1]) if kept}
+    if keep[-1] and known_face_uids[-1] in live_uids:
+        keep[-1] = False
+    
+    if keep.all():
+        return False
+    
+    known_matrix = np.ascontiguousarray(known_matrix[keep])
+    known_face_ids = [wid for wid, kept in zip(known_face_ids, keep) if kept]
+    known_face_uids = [uid for uid, kept in zip(known_face_uids, keep) if kept]
+    return True
+
+def _load_metadata(metadata_file: str) -> Dict[int, Dict]:
+    """Read worker metadata; a missing or unreadable file only costs the metadata"""
+    if not os.path.exists(metadata_file):
+        return {}
+    
+    try:
+        with open(metadata_file, 'r') as f:
+            data = json.load(f)
+        return {int(wid): meta for wid, meta in data['workers'].items()}
+    except Exception as e:
+        print(f"⚠️  Could not read worker metadata from {metadata_file}: {e}")
+        return {}
 
 def load_known_faces():
     """Load known faces from disk into memory"""
-    global known_face_encodings, known_face_ids, known_face_metadata
-    
-    known_faces_file = CONFIG['KNOWN_FACES_FILE']
+    global known_matrix, known_face_ids, known_face_uids, known_face_metadata, next_face_uid, store_writable
     
-    if os.path.exists(known_faces_file):
+    with _lock:
+        store_writable = False
+        matrix_file = CONFIG['KNOWN_MATRIX_FILE']
+        ids_file = CONFIG['KNOWN_IDS_FILE']
+        uids_file = CONFIG['KNOWN_UIDS_FILE']
+        metadata_file = CONFIG['KNOWN_METADATA_FILE']
+        legacy_file = CONFIG['LEGACY_FACES_FILE']
+        
         try:
-            with open(known_faces_file, 'rb') as f:
-                data = pickle.load(f)
-                known_face_encodings = data['encodings']
-                known_face_ids = data['ids']
-                known_face_metadata = data.get('metadata', {})
-            
-            print(f"✅ Loaded {len(known_face_ids)} known faces from {known_faces_file}")
-            print(f"   Workers with faces: {len(set(known_face_ids))}")
+            matrix = _read_store(matrix_file, MATRIX_MAGIC, np.float32, (128,))
+            ids = _read_store(ids_file, IDS_MAGIC, np.int32, ())
+            uids = _read_store(uids_file, UIDS_MAGIC, np.int64, ())
             
+            if matrix is not None and ids is not None and uids is not None:
+                # Map the encodings instead of parsing them; pages load on first touch.
+                # A crash between appends leaves some files rows ahead of the others.
+                count = min(len(matrix), len(ids), len(uids))
+                for path, rows in ((matrix_file, matrix), (ids_file, ids), (uids_file, uids)):
+                    if len(rows) != count:
+                        _truncate_store(path, count)
+                known_matrix = matrix[:count]
+                known_face_ids = ids[:count].tolist()
+                known_face_uids = uids[:count].tolist()
+                
+                # Never hand out a face id twice, even if the newest face was deleted
+                next_face_uid = _read_store_next_id(uids_file)
+                if known_face_uids:
+                    next_face_uid = max(next_face_uid, max(known_face_uids) + 1)
+                
+                known_face_metadata = _load_metadata(metadata_file)
+                store_writable = True
+                
+                print(f"✅ Loaded {len(known_face_ids)} known faces from {matrix_file}")
+                
+                if _repair_store():
+                    print("⚠️  Dropped rows left behind by an interrupted delete")
+                    store_writable = save_known_faces()
+                
+            elif os.path.exists(legacy_file) and os.path.getsize(legacy_file) > 0:
+                _load_legacy_faces(legacy_file)
+                next_face_uid = len(known_face_uids)
+                print(f"✅ Loaded {len(known_face_ids)} known faces from legacy file {legacy_file}")
+                print(f"⚠️  {legacy_file} was encoded from channel-swapped (BGR) images and matches")
+                print(f"   correctly decoded photos less reliably; re-enroll its {len(set(known_face_ids))} workers")
+                store_writable = save_known_faces()
+                
+            else:
+                print(f"ℹ️  No known faces file found at {matrix_file}. Starting fresh.")
+                known_matrix = np.empty((0, 128), dtype=np.float32)
+                known_face_ids = []
+                known_face_uids = []
+                known_face_metadata = {}
+                next_face_uid = 0
+                
+                # Replace any file left from a store that never got all three:
+                # appending to a straggler would misalign rows with the others
+                stragglers = [path for path in (matrix_file, ids_file, uids_file) if os.path.exists(path)]
+                if stragglers:
+                    print(f"⚠️  Discarding incomplete face store: {', '.join(stragglers)}")
+                _write_store(matrix_file, MATRIX_MAGIC, np.empty((0, 128), dtype=np.float32))
+                _write_store(uids_file, UIDS_MAGIC, np.empty(0, dtype=np.int64))
+                _write_store(ids_file, IDS_MAGIC, np.empty(0, dtype=np.int32))
+                store_writable = True
+                
         except Exception as e:
             print(f"❌ Error loading known faces: {e}")
-            known_face_encodings = []
+            print("   Enrollment and deletion are disabled until the store loads")
+            known_matrix = np.empty((0, 128), dtype=np.float32)
             known_face_ids = []
+            known_face_uids = []
             known_face_metadata = {}
-    else:
-        print(f"ℹ️  No known faces file found at {known_faces_file}. Starting fresh.")
-        known_face_encodings = []
-        known_face_ids = []
-        known_face_metadata = {}
+            next_face_uid = 0
+        
+        _rebuild_worker_index()
+        _rebuild_match_cache()
+        
+        print(f"   Workers with faces: {count_known_workers()}")
 
-def save_known_faces():
-    """Save known faces to disk"""
+def save_known_metadata():
+    """Save worker metadata to disk"""
     try:
-        data = {
-            'encodings': known_face_encodings,
-            'ids': known_face_ids,
-            'metadata': known_face_metadata,
-            'saved_at': datetime.now().isoformat(),
-            'version': '1.0'
-        }
+        with _lock:
+            tmp_path = f"{CONFIG['KNOWN_METADATA_FILE']}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'workers': known_face_metadata}, f)
+            os.replace(tmp_path, CONFIG['KNOWN_METADATA_FILE'])
+        return True
         
-        with open(CONFIG['KNOWN_FACES_FILE'], 'wb') as f:
-            pickle.dump(data, f)
+    except Exception as e:
+        print(f"❌ Error saving face metadata: {e}")
+        return False
+
+def save_known_faces():
+    """Rewrite the whole face store to disk (migration and repair only)"""
+    try:
+        with _lock:
+            _write_store(CONFIG['KNOWN_MATRIX_FILE'], MATRIX_MAGIC, known_matrix.astype(np.float32, copy=False))
+            _write_store(CONFIG['KNOWN_UIDS_FILE'], UIDS_MAGIC, np.asarray(known_face_uids, dtype=np.int64), next_face_uid)
+            _write_store(CONFIG['KNOWN_IDS_FILE'], IDS_MAGIC, np.asarray(known_face_ids, dtype=np.int32))
+            save_known_metadata()
         
-        print(f"💾 Saved {len(known_face_ids)} face encodings to {CONFIG['KNOWN_FACES_FILE']}")
+        print(f"💾 Saved {len(known_face_ids)} face encodings to {CONFIG['KNOWN_MATRIX_FILE']}")
         return True
         
     except Exception as e:
         print(f"❌ Error saving known faces: {e}")
         return False
 
-def preprocess_image(image_path: str) -> Optional[np.ndarray]:
+def _exif_orientation(image_data: bytes) -> int:
+    """EXIF orientation tag (1-8) of an encoded image; 1 (upright) if absent"""
+    try:
+        return int(Image.open(io.BytesIO(image_data)).getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+def _apply_exif_orientation(image: np.ndarray, orientation: int) -> np.ndarray:
+    """Rotate/flip decoded pixels upright, as cv2.imdecode does on its own"""
+    if orientation == 2:
+        image = image[:, ::-1]
+    elif orientation == 3:
+        image = image[::-1, ::-1]
+    elif orientation == 4:
+        image = image[::-1]
+    elif orientation == 5:
+        image = image.transpose(1, 0, 2)
+    elif orientation == 6:
+        image = np.rot90(image, -1)
+    elif orientation == 7:
+        image = image[::-1, ::-1].transpose(1, 0, 2)
+    elif orientation == 8:
+        image = np.rot90(image)
+    else:
+        return image
+    return np.ascontiguousarray(image)
+
+def _decode_image_bytes(image_data: bytes) -> Tuple[np.ndarray, int]:
+    """
+    Decode an uploaded image to RGB. JPEGs go through libjpeg-turbo when
+    available, which can downscale in the DCT domain while decoding; other
+    formats (or a missing TurboJPEG) fall back to OpenCV.
+    Returns: (image, longest side of the image as uploaded)
+    """
+    if _jpeg is not None:
+        try:
+            width, height, _, _ = _jpeg.decode_header(image_data)
+            longest = max(width, height)
+            
+            # Smallest supported scaling factor that still leaves IMAGE_SIZE to work with
+            target = max(CONFIG['IMAGE_SIZE'])
+            factors = [f for f in _jpeg.scaling_factors if f[0] <= f[1] and longest * f[0] >= target * f[1]]
+            scaling_factor = min(factors, key=lambda f: f[0] / f[1]) if factors else (1, 1)
+            
+            image = _jpeg.decode(image_data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+        except Exception:
+            pass  # Not a JPEG
+        else:
+            # libjpeg-turbo ignores EXIF, so portrait phone photos would reach HOG sideways
+            return _apply_exif_orientation(image, _exif_orientation(image_data)), longest
+    
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image data')
+    
+    # OpenCV decodes to BGR, face_recognition expects RGB
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), max(image.shape[:2])
+
+def preprocess_image(image_data: Union[str, bytes]) -> Tuple[Optional[np.ndarray], float]:
     """
     Preprocess image: resize, convert to RGB, enhance if needed
+    Accepts a file path or the encoded image bytes of an upload
+    Returns: (image, scale) where scale maps original to resized coordinates
     """
     try:
-        # Load image
-        image = face_recognition.load_image_file(image_path)
+        # Load image, decoding uploads in memory instead of via a temp file
+        if isinstance(image_data, (bytes, bytearray, memoryview)):
+            image, original_size = _decode_image_bytes(image_data)
+        else:
+            # load_image_file already returns RGB
+            image = face_recognition.load_image_file(image_data)
+            original_size = max(image.shape[:2])
         
-        # Convert BGR to RGB (face_recognition uses RGB)
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError(f'Expected an 8-bit RGB image, got {image.dtype} {image.shape}')
         
-        # Resize if too large (for performance)
+        # Downscale to IMAGE_SIZE before detection (HOG cost grows with pixel count)
         height, width = image.shape[:2]
-        if height > 1000 or width > 1000:
-            scale = 1000 / max(height, width)
-            new_height = int(height * scale)
-            new_width = int(width * scale)
-            image = cv2.resize(image, (new_width, new_height))
+        resize = min(max(CONFIG['IMAGE_SIZE']) / max(height, width), 1.0)
+        if resize < 1.0:
+            new_height = max(int(height * resize), 1)
+            new_width = max(int(width * resize), 1)
+            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
         
-        return image
+        # Overall scale, including any downscaling done while decoding
+        scale = max(image.shape[:2]) / original_size
+        return image, scale
         
     except Exception as e:
         print(f"❌ Error preprocessing image: {e}")
-        return None
+        return None, 1.0
+
+def scale_face_locations(face_locations: List[Tuple], scale: float) -> List[Tuple]:
+    """Map (top, right, bottom, left) locations on a resized image back to the original"""
+    if scale == 1.0:
+        return face_locations
+    return [tuple(int(round(v / scale)) for v in location) for location in face_locations]
+
+def _detect(image: np.ndarray, upsample: int = 1) -> List[Tuple]:
+    """Run the HOG detector, returning (top, right, bottom, left) boxes clipped to the image"""
+    height, width = image.shape[:2]
+    return [
+        (max(rect.top(), 0), min(rect.right(), width), min(rect.bottom(), height), max(rect.left(), 0))
+        for rect in _detector(image, upsample)
+    ]
+
+def _detect_cnn_batch(images: List[Optional[np.ndarray]]) -> List[List[Tuple]]:
+    """
+    Run the CNN detector over several images in GPU batches. The batch call
+    needs equally sized images, so each is zero-padded at the bottom/right
+    to the largest size; boxes are then clipped to the original image.
+    """
+    valid = [i for i, image in enumerate(images) if image is not None]
+    locations = [[] for _ in images]
+    if not valid:
+        return locations
+    
+    height = max(images[i].shape[0] for i in valid)
+    width = max(images[i].shape[1] for i in valid)
+    padded = []
+    for i in valid:
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        canvas[:images[i].shape[0], :images[i].shape[1]] = images[i]
+        padded.append(canvas)
+    
+    batched = face_recognition.batch_face_locations(
+        padded,
+        number_of_times_to_upsample=0,
+        batch_size=CONFIG['CNN_BATCH_SIZE']
+    )
+    
+    for i, face_locations in zip(valid, batched):
+        image_height, image_width = images[i].shape[:2]
+        locations[i] = [
+            (top, min(right, image_width), min(bottom, image_height), left)
+            for top, right, bottom, left in face_locations
+            if top < image_height and left < image_width
+        ]
+    
+    return locations
+
+def _landmarks(image: np.ndarray, face_locations: List[Tuple]):
+    """5-point landmarks for each (top, right, bottom, left) box"""
+    shapes = dlib.full_object_detections()
+    for top, right, bottom, left in face_locations:
+        shapes.append(_sp_5pt(image, dlib.rectangle(left, top, right, bottom)))
+    return shapes
+
+def _encode(image: np.ndarray, face_locations: List[Tuple], jitters: int = 0) -> List[np.ndarray]:
+    """128-D float32 encodings for each (top, right, bottom, left) box in one encoder call"""
+    descriptors = _encoder.compute_face_descriptor(image, _landmarks(image, face_locations), jitters)
+    return [np.array(d, dtype=np.float32) for d in descriptors]
 
-def detect_and_encode_faces(image_path: str) -> Tuple[List[np.ndarray], List[Tuple]]:
+def detect_and_encode_faces(image_data: Union[str, bytes], jitters: int = 0) -> Tuple[List[np.ndarray], List[Tuple]]:
     """
     Detect faces in image and return encodings and locations
+    jitters > 1 averages that many randomly distorted re-samples per face,
+    which only pays off when enrolling; 0 runs a single encoder pass
     Returns: (encodings, face_locations)
     """
     try:
         # Preprocess image
-        image = preprocess_image(image_path)
+        image, scale = preprocess_image(image_data)
         if image is None:
             return [], []
         
         # Detect face locations
-        face_locations = face_recognition.face_locations(
-            image,
-            model='hog',  # Use 'hog' for CPU, 'cnn' for GPU (more accurate but slower)
-            number_of_times_to_upsample=1
-        )
+        face_locations = _detect(image, upsample=1)
         
         if not face_locations:
             return [], []
         
         # Get face encodings
-        face_encodings = face_recognition.face_encodings(
-            image,
-            face_locations,
-            num_jitters=1,  # Number of times to re-sample the face
-            model='small'   # Use 'small' for faster encoding
-        )
+        face_encodings = _encode(image, face_locations, jitters)
         
-        return face_encodings, face_locations
+        return face_encodings, scale_face_locations(face_locations, scale)
         
     except Exception as e:
         print(f"❌ Error detecting/encoding faces: {e}")
         return [], []
 
-def find_best_match(face_encoding: np.ndarray, threshold: float = None) -> Tuple[Optional[int], float]:
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _sq_l2_kernel(matrix, query):
+        """Squared L2 distance of every row to query in one fused pass over the matrix"""
+        n, d = matrix.shape
+        out = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            s = np.float32(0.0)
+            for j in range(d):
+                t = matrix[i, j] - query[j]
+                s += t * t
+            out[i] = s
+        return out
+else:
+    _sq_l2_kernel = None
+
+def _squared_distances(query: np.ndarray) -> np.ndarray:
     """
-    Find the best matching worker for a face encoding
-    Returns: (worker_id, confidence) or (None, 0.0) if no match
+    Squared L2 distances from a float32 query to every known face:
+    ||K - q||^2 = ||K||^2 + ||q||^2 - 2 * K @ q
     """
-    if threshold is None:
-        threshold = CONFIG['FACE_MATCH_THRESHOLD']
+    if _sq_l2_kernel is not None and len(known_matrix) >= CONFIG['NUMBA_MIN_FACES']:
+        return _sq_l2_kernel(np.asarray(known_matrix), query)
+    return known_sq_norms + query @ query - 2.0 * (known_matrix @ query)
+
+def _nearest_row(query: np.ndarray, threshold: float) -> Tuple[int, float]:
+    """
+    Nearest known row to a float32 query and its squared distance.
+    A match needs distance <= 1 - threshold, and by the triangle inequality
+    | ||K_i|| - ||q|| | <= ||K_i - q||, so only rows whose norm lies within
+    that radius of the query's can match. Those are a contiguous run of the
+    norm-sorted rows; the full scan only runs when the run holds no match.
+    """
+    if CONFIG['NORM_PREFILTER']:
+        if known_norm_order is None:
+            _rebuild_norm_order()
+        
+        radius = 1.0 - threshold
+        query_sq_norm = float(query @ query)
+        query_norm = np.sqrt(query_sq_norm)
+        lo = np.searchsorted(known_sorted_norms, query_norm - radius, side='left')
+        hi = np.searchsorted(known_sorted_norms, query_norm + radius, side='right')
+        
+        if 0 < hi - lo < len(known_matrix):
+            rows = known_norm_order[lo:hi]
+            sq_distances = known_sq_norms[rows] + query_sq_norm - 2.0 * (known_matrix[rows] @ query)
+            best = int(np.argmin(sq_distances))
+            if np.sqrt(max(float(sq_distances[best]), 0.0)) <= radius:
+                return int(rows[best]), float(sq_distances[best])
     
-    if not known_face_encodings:
-        return None, 0.0
+    sq_distances = _squared_distances(query)
+    best_match_index = int(np.argmin(sq_distances))
+    return best_match_index, float(sq_distances[best_match_index])
+
+def encode_single_faces_batch(images_data: List[Union[str, bytes]], jitters: int = 0) -> List[Tuple[List[np.ndarray], List[Tuple]]]:
+    """
+    Detect and encode faces for several images with a single batched
+    descriptor call. Only images containing exactly one face are encoded;
+    others come back with no encodings but keep their face locations.
+    Returns: one (encodings, face_locations) pair per input, in input order
+    """
+    try:
+        images, scales = zip(*[preprocess_image(image_data) for image_data in images_data])
+        
+        # Detect face locations, batched on the GPU when the CNN detector is in use
+        if CONFIG['DETECTOR'] == 'cnn':
+            locations = _detect_cnn_batch(images)
+        else:
+            locations = [_detect(image, upsample=1) if image is not None else [] for image in images]
+        results = [
+            ([], scale_face_locations(face_locations, scale))
+            for face_locations, scale in zip(locations, scales)
+        ]
+        
+        # Landmarks for every single-face image, then one batched forward pass
+        batch = [i for i, face_locations in enumerate(locations) if len(face_locations) == 1]
+        if not batch:
+            return results
+        
+        descriptors = _encoder.compute_face_descriptor(
+            [images[i] for i in batch],
+            [_landmarks(images[i], locations[i]) for i in batch],
+            jitters  # Number of times to re-sample the face
+        )
+        
+        for i, face_descriptors in zip(batch, descriptors):
+            results[i] = ([np.array(d, dtype=np.float32) for d in face_descriptors], results[i][1])
+        
+        return results
+        
+    except Exception as e:
+        print(f"⚠️  Batched encoding failed, falling back to per-image: {e}")
+        return [detect_and_encode_faces(image_data, jitters) for image_data in images_data]
+
+def _init_worker():
+    """Warm up the detector once per pool process so the first request pays no setup cost"""
+    cv2.setNumThreads(1)
+    _detector(np.zeros((64, 64, 3), dtype=np.uint8), 0)
+
+def _start_executor(workers: int) -> ProcessPoolExecutor:
+    """Start detection workers, each loading the dlib models once"""
+    # Never fork the service itself: request, batcher and index threads may
+    # hold locks a forked child would inherit locked forever. The forkserver
+    # is forked while still single-threaded and imports this module up
+    # front, so workers share the dlib models. Windows only has spawn.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context('spawn')
     
-    # Calculate face distances to all known faces
-    face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker
+    )
+
+def _replace_broken_executor(broken: ProcessPoolExecutor):
+    """Swap in a fresh pool after a worker died (OOM kill, dlib crash)"""
+    global executor, gpu_executor
     
-    # Find the best match (smallest distance)
-    best_match_index = np.argmin(face_distances)
-    best_distance = face_distances[best_match_index]
+    with _executor_lock:
+        # Another request thread may already have replaced it
+        if executor is broken:
+            executor = _start_executor(CONFIG['DETECTION_WORKERS'])
+        elif gpu_executor is broken:
+            gpu_executor = _start_executor(CONFIG['GPU_DETECTION_WORKERS'])
+        else:
+            return
+        
+        print("⚠️  Detection worker died, restarting its pool")
+        broken.shutdown(wait=False)
+
+def run_detection(func, *args, timeout: float = None, gpu: bool = False):
+    """
+    Run a detection/encoding function in the process pool if it is running,
+    or in the GPU pool when gpu is set and one was started.
+    A pool broken by a crashed worker is replaced and the job retried once.
+    """
+    if executor is None:
+        return func(*args)
     
-    # Convert distance to confidence (0-1, higher is better)
-    confidence = 1.0 - best_distance
+    if timeout is None:
+        timeout = CONFIG['DETECTION_TIMEOUT']
     
-    # Check if confidence meets threshold
-    if confidence >= threshold:
-        worker_id = known_face_ids[best_match_index]
-        return worker_id, float(confidence)
+    for attempt in range(2):
+        pool = gpu_executor if gpu and gpu_executor is not None else executor
+        try:
+            future = pool.submit(func, *args)
+            try:
+                return future.result(timeout=timeout)
+            finally:
+                # No-op once the job ran; drops it from the queue after a
+                # timeout so an overloaded pool does not keep growing its backlog
+                future.cancel()
+        except BrokenProcessPool:
+            if attempt:
+                raise
+            _replace_broken_executor(pool)
+
+def frame_digest(image_data: bytes) -> bytes:
+    """128-bit digest of the exact upload bytes, used as the frame cache key"""
+    return hashlib.blake2b(image_data, digest_size=16).digest()
+
+def frame_cache_get(frame_key: bytes) -> Optional[Tuple[int, float, Optional[Tuple]]]:
+    """Return a cached (worker_id, confidence, face_location) if still fresh"""
+    with _lock:
+        entry = _frame_cache.get(frame_key)
+        if entry is None:
+            return None
+        
+        if time.monotonic() - entry[0] > CONFIG['FRAME_CACHE_TTL']:
+            _frame_cache.pop(frame_key, None)
+            return None
+        
+        return entry[1:]
+
+def frame_cache_put(frame_key: bytes, generation: int, worker_id: int, confidence: float, face_location: Optional[Tuple]):
+    """
+    Remember a recognition result, evicting the oldest entries past
+    FRAME_CACHE_SIZE. Dropped if the cache was cleared since generation
+    was read, i.e. the result may predate a delete or threshold change.
+    """
+    with _lock:
+        if generation != _frame_cache_generation:
+            return
+        
+        _frame_cache[frame_key] = (time.monotonic(), worker_id, confidence, face_location)
+        _frame_cache.move_to_end(frame_key)
+        while len(_frame_cache) > CONFIG['FRAME_CACHE_SIZE']:
+            _frame_cache.popitem(last=False)
+
+def frame_cache_clear():
+    """Forget all cached results and invalidate any still being computed"""
+    global _frame_cache_generation
+    
+    with _lock:
+        _frame_cache.clear()
+        _frame_cache_generation += 1
+
+def find_best_matches(face_encodings: List[np.ndarray], threshold: float = None) -> List[Tuple[Optional[int], float]]:
+    """
+    Find the best matching worker for each of several face encodings,
+    resolving them together (one GEMM instead of one GEMV per face)
+    Returns: one (worker_id, confidence) or (None, confidence) per encoding
+    """
+    if threshold is None:
+        threshold = CONFIG['FACE_MATCH_THRESHOLD']
     
-    return None, float(confidence)
+    with _lock:
+        if len(known_matrix) == 0:
+            return [(None, 0.0) for _ in face_encodings]
+        
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, 128)
+        
+        if faiss_index is not None:
+            # Sub-linear HNSW search; returns the squared L2 distance of the nearest row
+            sq_distance, index = faiss_index.search(queries, 1)
+            best_match_indices = [int(label) for label in index[:, 0]]
+            best_sq_distances = [float(d) for d in sq_distance[:, 0]]
+            
+            # Label -1 means the graph returned nothing; never index rows with it
+            for i, label in enumerate(best_match_indices):
+                if label < 0:
+                    best_match_indices[i], best_sq_distances[i] = _nearest_row(queries[i], threshold)
+        elif len(queries) > 1:
+            # Squared distances of all known faces to all queries in one GEMM
+            sq_distances = (
+                known_sq_norms[:, None]
+                + np.einsum('ij,ij->i', queries, queries)[None, :]
+                - 2.0 * (known_matrix @ queries.T)
+            )
+            best_match_indices = np.argmin(sq_distances, axis=0)
+            best_sq_distances = sq_distances[best_match_indices, np.arange(len(queries))]
+        else:
+            # One GEMV per query, over the norm-prefiltered rows where possible
+            best_match_indices = []
+            best_sq_distances = []
+            for query in queries:
+                best_match_index, best_sq_distance = _nearest_row(query, threshold)
+                best_match_indices.append(best_match_index)
+                best_sq_distances.append(best_sq_distance)
+        
+        matches = []
+        for best_match_index, best_sq_distance in zip(best_match_indices, best_sq_distances):
+            # Only the winning distance needs the square root
+            best_distance = float(np.sqrt(max(float(best_sq_distance), 0.0)))
+            
+            # Convert distance to confidence (0-1, higher is better)
+            confidence = 1.0 - best_distance
+            
+            # Check if confidence meets threshold
+            if confidence >= threshold:
+                matches.append((known_face_ids[int(best_match_index)], float(confidence)))
+            else:
+                matches.append((None, float(confidence)))
+        
+        return matches
+
+def find_best_match(face_encoding: np.ndarray, threshold: float = None) -> Tuple[Optional[int], float]:
+    """
+    Find the best matching worker for a face encoding
+    Returns: (worker_id, confidence) or (None, 0.0) if no match
+    """
+    return find_best_matches([face_encoding], threshold)[0]
+
+def _recognize_batcher():
+    """Background loop resolving queued /recognize images in batches"""
+    while True:
+        batch = [_recognize_queue.get()]
+        deadline = time.monotonic() + CONFIG['RECOGNIZE_BATCH_WAIT']
+        while len(batch) < CONFIG['RECOGNIZE_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_recognize_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        futures = [future for _, future in batch]
+        try:
+            # One batched encoder pass for all single-face images...
+            results = run_detection(
+                encode_single_faces_batch,
+                [image_data for image_data, _ in batch],
+                0,
+                timeout=CONFIG['DETECTION_TIMEOUT'] * len(batch),
+                gpu=CONFIG['DETECTOR'] == 'cnn'
+            )
+            
+            # ...then one matrix product to resolve every identity
+            single = [i for i, (face_encodings, _) in enumerate(results) if len(face_encodings) == 1]
+            matches = find_best_matches([results[i][0][0] for i in single]) if single else []
+            match_for = dict(zip(single, matches))
+            
+            for i, future in enumerate(futures):
+                future.set_result((results[i][1], match_for.get(i)))
+                
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+def recognize_image(image_data: bytes) -> Tuple[List[Tuple], Optional[Tuple[Optional[int], float]]]:
+    """
+    Detect, encode and match the faces in an uploaded image, through the
+    micro-batcher when RECOGNIZE_BATCHING is on
+    Returns: (face_locations, (worker_id, confidence)) where the match is
+    None unless exactly one face was found
+    """
+    global _batcher_thread
+    
+    if not CONFIG['RECOGNIZE_BATCHING']:
+        face_encodings, face_locations = run_detection(detect_and_encode_faces, image_data, 0)
+        match = find_best_match(face_encodings[0]) if len(face_encodings) == 1 else None
+        return face_locations, match
+    
+    with _batcher_lock:
+        if _batcher_thread is None:
+            _batcher_thread = threading.Thread(target=_recognize_batcher, name='recognize-batcher', daemon=True)
+            _batcher_thread.start()
+    
+    future = Future()
+    _recognize_queue.put((image_data, future))
+    return future.result(timeout=CONFIG['DETECTION_TIMEOUT'] * CONFIG['RECOGNIZE_BATCH_SIZE'])
 
 @app.route('/recognize', methods=['POST'])
 def recognize():
@@ -205,45 +1204,51 @@ def recognize():
                 'code': 'EMPTY_FILE'
             }), 400
         
-        # Save temporary file
-        temp_filename = f"temp_{datetime.now().timestamp()}_{image_file.filename}"
-        temp_path = os.path.join(CONFIG['TEMP_DIR'], temp_filename)
-        image_file.save(temp_path)
+        # Read the upload into memory
+        image_data = image_file.read()
         
-        # Detect and encode faces
-        face_encodings, face_locations = detect_and_encode_faces(temp_path)
+        # Re-uploads of the exact same image skip detection entirely
+        frame_key = frame_digest(image_data)
+        cache_generation = _frame_cache_generation
+        cached = frame_cache_get(frame_key)
+        if cached is not None:
+            worker_id, confidence, face_location = cached
+            return jsonify({
+                'success': True,
+                'worker_id': worker_id,
+                'confidence': confidence,
+                'message': 'Face recognized successfully',
+                'metadata': known_face_metadata.get(worker_id, {}),
+                'face_location': face_location,
+                'cached': True
+            })
         
-        # Clean up temp file
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        # Detect, encode and match faces
+        face_locations, match = recognize_image(image_data)
         
         # Check results
-        if not face_encodings:
-            return jsonify({
-                'success': False,
-                'message': 'No face detected in the image',
-                'code': 'NO_FACE_DETECTED'
-            }), 404
-        
-        if len(face_encodings) > 1:
+        if len(face_locations) > 1:
             return jsonify({
                 'success': False,
                 'message': 'Multiple faces detected. Please ensure only one face is visible.',
                 'code': 'MULTIPLE_FACES',
-                'faces_detected': len(face_encodings)
+                'faces_detected': len(face_locations)
             }), 400
         
-        # Get the face encoding
-        face_encoding = face_encodings[0]
+        if match is None:
+            return jsonify({
+                'success': False,
+                'message': 'No face detected in the image',
+                'code': 'NO_FACE_DETECTED'
+            }), 404
         
-        # Find best match
-        worker_id, confidence = find_best_match(face_encoding)
+        worker_id, confidence = match
         
         if worker_id is not None:
             # Get worker metadata
             metadata = known_face_metadata.get(worker_id, {})
+            face_location = face_locations[0] if face_locations else None
+            frame_cache_put(frame_key, cache_generation, worker_id, confidence, face_location)
             
             return jsonify({
                 'success': True,
@@ -251,7 +1256,8 @@ def recognize():
                 'confidence': confidence,
                 'message': 'Face recognized successfully',
                 'metadata': metadata,
-                'face_location': face_locations[0] if face_locations else None
+                'face_location': face_location,
+                'cached': False
             })
         else:
             return jsonify({
@@ -305,19 +1311,15 @@ def enroll():
         
         image_file = request.files['image']
         
-        # Save temporary file
-        temp_filename = f"enroll_{worker_id}_{datetime.now().timestamp()}.jpg"
-        temp_path = os.path.join(CONFIG['TEMP_DIR'], temp_filename)
-        image_file.save(temp_path)
+        # Read the upload into memory
+        image_data = image_file.read()
         
         # Detect and encode faces
-        face_encodings, face_locations = detect_and_encode_faces(temp_path)
-        
-        # Clean up temp file
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        face_encodings, face_locations = run_detection(
+            detect_and_encode_faces,
+            image_data,
+            CONFIG['ENROLL_JITTERS']
+        )
         
         # Check results
         if not face_encodings:
@@ -337,49 +1339,49 @@ def enroll():
         # Get the face encoding
         face_encoding = face_encodings[0]
         
-        # Check if worker already has too many faces enrolled
-        worker_face_count = known_face_ids.count(worker_id)
-        if worker_face_count >= CONFIG['MAX_FACES_PER_WORKER']:
-            return jsonify({
-                'success': False,
-                'message': f'Worker already has {worker_face_count} faces enrolled (max: {CONFIG["MAX_FACES_PER_WORKER"]})',
-                'code': 'MAX_FACES_REACHED'
-            }), 400
-        
-        # Add to known faces
-        known_face_encodings.append(face_encoding)
-        known_face_ids.append(worker_id)
-        
-        # Update metadata
-        if worker_id not in known_face_metadata:
-            known_face_metadata[worker_id] = {
-                'first_enrolled': datetime.now().isoformat(),
-                'last_enrolled': datetime.now().isoformat(),
-                'total_faces': 1,
-                'enrollment_dates': [datetime.now().isoformat()]
-            }
-        else:
-            metadata = known_face_metadata[worker_id]
-            metadata['last_enrolled'] = datetime.now().isoformat()
-            metadata['total_faces'] = worker_face_count + 1
-            metadata['enrollment_dates'].append(datetime.now().isoformat())
-        
-        # Save to disk
-        save_known_faces()
+        with _lock:
+            # Check if worker already has too many faces enrolled
+            worker_face_count = worker_counts[worker_id]
+            if worker_face_count >= CONFIG['MAX_FACES_PER_WORKER']:
+                return jsonify({
+                    'success': False,
+                    'message': f'Worker already has {worker_face_count} faces enrolled (max: {CONFIG["MAX_FACES_PER_WORKER"]})',
+                    'code': 'MAX_FACES_REACHED'
+                }), 400
+            
+            # Add to known faces
+            face_uid = _append_faces([face_encoding], worker_id)[0]
+            
+            # Update metadata
+            if worker_id not in known_face_metadata:
+                known_face_metadata[worker_id] = {
+                    'first_enrolled': datetime.now().isoformat(),
+                    'last_enrolled': datetime.now().isoformat(),
+                    'total_faces': 1,
+                    'enrollment_dates': [datetime.now().isoformat()]
+                }
+            else:
+                metadata = known_face_metadata[worker_id]
+                metadata['last_enrolled'] = datetime.now().isoformat()
+                metadata['total_faces'] = worker_face_count + 1
+                metadata['enrollment_dates'].append(datetime.now().isoformat())
+            
+            # Save to disk
+            save_known_metadata()
         
         # Save original image to known_faces directory
-        original_filename = f"worker_{worker_id}_{len(known_face_encodings)}.jpg"
+        original_filename = f"worker_{worker_id}_{face_uid}.jpg"
         original_path = os.path.join(CONFIG['KNOWN_FACES_DIR'], original_filename)
-        image_file.seek(0)  # Reset file pointer
-        image_file.save(original_path)
+        with open(original_path, 'wb') as f:
+            f.write(image_data)
         
         return jsonify({
             'success': True,
             'message': 'Face enrolled successfully',
             'worker_id': worker_id,
-            'face_index': len(known_face_encodings) - 1,
+            'face_uid': face_uid,
             'total_faces_for_worker': worker_face_count + 1,
-            'total_faces_in_system': len(known_face_encodings),
+            'total_faces_in_system': count_known_faces(),
             'image_saved_as': original_filename
         })
         
@@ -418,25 +1420,22 @@ def enroll_batch():
         failed = 0
         results = []
         
-        for i, image_file in enumerate(images):
-            # Save temporary file
-            temp_filename = f"batch_{worker_id}_{i}_{datetime.now().timestamp()}.jpg"
-            temp_path = os.path.join(CONFIG['TEMP_DIR'], temp_filename)
-            image_file.save(temp_path)
-            
-            # Detect and encode
-            face_encodings, _ = detect_and_encode_faces(temp_path)
-            
-            # Clean up
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-            
+        # Read all uploads first so the batch is encoded in one pass
+        images_data = [image_file.read() for image_file in images]
+        
+        # Detect and encode
+        batch_results = run_detection(
+            encode_single_faces_batch,
+            images_data,
+            CONFIG['ENROLL_JITTERS'],
+            timeout=CONFIG['DETECTION_TIMEOUT'] * len(images_data),
+            gpu=CONFIG['DETECTOR'] == 'cnn'
+        )
+        
+        new_encodings = []
+        for i, (face_encodings, _) in enumerate(batch_results):
             if face_encodings and len(face_encodings) == 1:
-                # Add to known faces
-                known_face_encodings.append(face_encodings[0])
-                known_face_ids.append(worker_id)
+                new_encodings.append(face_encodings[0])
                 successful += 1
                 results.append({
                     'image_index': i,
@@ -452,22 +1451,28 @@ def enroll_batch():
                 })
         
         # Update metadata
-        if successful > 0:
-            if worker_id not in known_face_metadata:
-                known_face_metadata[worker_id] = {
-                    'first_enrolled': datetime.now().isoformat(),
-                    'last_enrolled': datetime.now().isoformat(),
-                    'total_faces': successful,
-                    'enrollment_dates': [datetime.now().isoformat()]
-                }
-            else:
-                metadata = known_face_metadata[worker_id]
-                metadata['last_enrolled'] = datetime.now().isoformat()
-                metadata['total_faces'] += successful
-                metadata['enrollment_dates'].append(datetime.now().isoformat())
+        with _lock:
+            if successful > 0:
+                # Add to known faces
+                _append_faces(new_encodings, worker_id)
+                
+                if worker_id not in known_face_metadata:
+                    known_face_metadata[worker_id] = {
+                        'first_enrolled': datetime.now().isoformat(),
+                        'last_enrolled': datetime.now().isoformat(),
+                        'total_faces': successful,
+                        'enrollment_dates': [datetime.now().isoformat()]
+                    }
+                else:
+                    metadata = known_face_metadata[worker_id]
+                    metadata['last_enrolled'] = datetime.now().isoformat()
+                    metadata['total_faces'] += successful
+                    metadata['enrollment_dates'].append(datetime.now().isoformat())
+                
+                # Save to disk
+                save_known_metadata()
             
-            # Save to disk
-            save_known_faces()
+            total_faces_for_worker = worker_counts[worker_id]
         
         return jsonify({
             'success': True,
@@ -476,7 +1481,7 @@ def enroll_batch():
             'successful': successful,
             'failed': failed,
             'results': results,
-            'total_faces_for_worker': known_face_ids.count(worker_id)
+            'total_faces_for_worker': total_faces_for_worker
         })
         
     except Exception as e:
@@ -489,57 +1494,54 @@ def enroll_batch():
 @app.route('/worker/<int:worker_id>/faces', methods=['GET'])
 def get_worker_faces(worker_id: int):
     """Get information about enrolled faces for a worker"""
-    face_indices = [i for i, wid in enumerate(known_face_ids) if wid == worker_id]
+    with _lock:
+        # Face ids in enrollment order; row positions change as faces are deleted
+        face_uids = sorted(known_face_uids[i] for i in worker_to_indices.get(worker_id, []))
+        metadata = dict(known_face_metadata.get(worker_id, {}))
     
-    if not face_indices:
+    if not face_uids:
         return jsonify({
             'success': False,
             'message': f'No faces found for worker {worker_id}',
             'worker_id': worker_id
         }), 404
     
-    metadata = known_face_metadata.get(worker_id, {})
-    
     return jsonify({
         'success': True,
         'worker_id': worker_id,
-        'face_count': len(face_indices),
-        'face_indices': face_indices,
+        'face_count': len(face_uids),
+        'face_uids': face_uids,
         'metadata': metadata,
-        'first_face_index': face_indices[0] if face_indices else None,
-        'last_face_index': face_indices[-1] if face_indices else None
+        'first_face_uid': face_uids[0] if face_uids else None,
+        'last_face_uid': face_uids[-1] if face_uids else None
     })
 
 @app.route('/worker/<int:worker_id>/faces', methods=['DELETE'])
 def delete_worker_faces(worker_id: int):
     """Delete all faces for a worker"""
     try:
-        # Find indices to remove
-        indices_to_remove = [i for i, wid in enumerate(known_face_ids) if wid == worker_id]
-        
-        if not indices_to_remove:
-            return jsonify({
-                'success': False,
-                'message': f'No faces found for worker {worker_id}'
-            }), 404
-        
-        # Remove in reverse order to maintain indices
-        for index in sorted(indices_to_remove, reverse=True):
-            known_face_encodings.pop(index)
-            known_face_ids.pop(index)
-        
-        # Remove metadata
-        if worker_id in known_face_metadata:
-            del known_face_metadata[worker_id]
-        
-        # Save to disk
-        save_known_faces()
+        with _lock:
+            if worker_id not in worker_to_indices:
+                return jsonify({
+                    'success': False,
+                    'message': f'No faces found for worker {worker_id}'
+                }), 404
+            
+            faces_deleted = _remove_worker_faces(worker_id)
+            frame_cache_clear()
+            
+            # Remove metadata
+            if worker_id in known_face_metadata:
+                del known_face_metadata[worker_id]
+            
+            # Save to disk
+            save_known_metadata()
         
         return jsonify({
             'success': True,
-            'message': f'Deleted {len(indices_to_remove)} faces for worker {worker_id}',
+            'message': f'Deleted {faces_deleted} faces for worker {worker_id}',
             'worker_id': worker_id,
-            'faces_deleted': len(indices_to_remove)
+            'faces_deleted': faces_deleted
         })
         
     except Exception as e:
@@ -552,44 +1554,44 @@ def delete_worker_faces(worker_id: int):
 @app.route('/status', methods=['GET'])
 def status():
     """Get service status and statistics"""
-    total_faces = len(known_face_encodings)
-    unique_workers = len(set(known_face_ids)) if known_face_ids else 0
-    
-    # Calculate average faces per worker
-    avg_faces_per_worker = total_faces / unique_workers if unique_workers > 0 else 0
-    
-    # Get worker with most faces
-    worker_counts = {}
-    for worker_id in known_face_ids:
-        worker_counts[worker_id] = worker_counts.get(worker_id, 0) + 1
-    
-    most_faces_worker = max(worker_counts.items(), key=lambda x: x[1]) if worker_counts else (None, 0)
-    
-    return jsonify({
-        'status': 'online',
-        'timestamp': datetime.now().isoformat(),
-        'service': 'Laberion Face Recognition',
-        'version': '1.0.0',
-        'statistics': {
-            'total_faces': total_faces,
-            'unique_workers': unique_workers,
-            'average_faces_per_worker': round(avg_faces_per_worker, 2),
-            'worker_with_most_faces': {
-                'worker_id': most_faces_worker[0],
-                'face_count': most_faces_worker[1]
+    with _lock:
+        total_faces = count_known_faces()
+        unique_workers = count_known_workers()
+        
+        # Calculate average faces per worker
+        avg_faces_per_worker = total_faces / unique_workers if unique_workers > 0 else 0
+        
+        # Get worker with most faces
+        most_faces_worker = worker_counts.most_common(1)[0] if worker_counts else (None, 0)
+        
+        return jsonify({
+            'status': 'online',
+            'timestamp': datetime.now().isoformat(),
+            'service': 'Laberion Face Recognition',
+            'version': '1.0.0',
+            'statistics': {
+                'total_faces': total_faces,
+                'unique_workers': unique_workers,
+                'average_faces_per_worker': round(avg_faces_per_worker, 2),
+                'worker_with_most_faces': {
+                    'worker_id': most_faces_worker[0],
+                    'face_count': most_faces_worker[1]
+                }
+            },
+            'configuration': {
+                'face_match_threshold': CONFIG['FACE_MATCH_THRESHOLD'],
+                'max_faces_per_worker': CONFIG['MAX_FACES_PER_WORKER'],
+                'ann_index': faiss_index is not None,
+                'cuda': _HAS_CUDA,
+                'detector': CONFIG['DETECTOR'],
+                'known_faces_file': CONFIG['KNOWN_MATRIX_FILE'],
+                'known_faces_dir': CONFIG['KNOWN_FACES_DIR']
+            },
+            'memory_usage': {
+                'face_encodings_size': f"{known_matrix.nbytes / 1024:.2f} KB",  # 128 float32s per face
+                'metadata_size': f"{len(str(known_face_metadata).encode('utf-8')) / 1024:.2f} KB"
             }
-        },
-        'configuration': {
-            'face_match_threshold': CONFIG['FACE_MATCH_THRESHOLD'],
-            'max_faces_per_worker': CONFIG['MAX_FACES_PER_WORKER'],
-            'known_faces_file': CONFIG['KNOWN_FACES_FILE'],
-            'known_faces_dir': CONFIG['KNOWN_FACES_DIR']
-        },
-        'memory_usage': {
-            'face_encodings_size': f"{total_faces * 128 * 8 / 1024:.2f} KB",  # 128 floats * 8 bytes each
-            'metadata_size': f"{len(str(known_face_metadata).encode('utf-8')) / 1024:.2f} KB"
-        }
-    })
+        })
 
 @app.route('/config/threshold', methods=['POST'])
 def update_threshold():
@@ -611,8 +1613,10 @@ def update_threshold():
                 'message': 'Threshold must be between 0.1 and 1.0'
             }), 400
         
-        old_threshold = CONFIG['FACE_MATCH_THRESHOLD']
-        CONFIG['FACE_MATCH_THRESHOLD'] = new_threshold
+        with _lock:
+            old_threshold = CONFIG['FACE_MATCH_THRESHOLD']
+            CONFIG['FACE_MATCH_THRESHOLD'] = new_threshold
+            frame_cache_clear()
         
         return jsonify({
             'success': True,
@@ -657,11 +1661,14 @@ def test():
         }
     })
 
-def main():
-    """Main function to start the service"""
-    print("=" * 60)
-    print("🚀 Laberion Face Recognition Service")
-    print("=" * 60)
+def init_service():
+    """
+    Load the face store and start the detection pool. Called by main(), or
+    as an app factory by an external WSGI server:
+        gunicorn -w 1 -k gthread --threads 8 --keep-alive 30 'app:init_service()'
+    Returns: the Flask app
+    """
+    global executor, gpu_executor
     
     # Initialize directories
     init_directories()
@@ -669,19 +1676,52 @@ def main():
     # Load known faces
     load_known_faces()
     
+    # Start detection workers, each loading the dlib models once
+    executor = _start_executor(CONFIG['DETECTION_WORKERS'])
+    if _HAS_CUDA:
+        gpu_executor = _start_executor(CONFIG['GPU_DETECTION_WORKERS'])
+    
+    # Compile the distance kernel now rather than on the first large scan
+    if _sq_l2_kernel is not None:
+        _sq_l2_kernel(np.zeros((1, 128), dtype=np.float32), np.zeros(128, dtype=np.float32))
+    
+    return app
+
+def main():
+    """Main function to start the service"""
+    print("=" * 60)
+    print("🚀 Laberion Face Recognition Service")
+    print("=" * 60)
+    
+    init_service()
+    
     # Get host and port from environment or use defaults
     host = os.environ.get('FACE_SERVICE_HOST', '0.0.0.0')
     port = int(os.environ.get('FACE_SERVICE_PORT', 5000))
     
     print(f"\n📡 Service starting on: http://{host}:{port}")
-    print(f"📁 Known faces loaded: {len(known_face_encodings)}")
-    print(f"👥 Unique workers: {len(set(known_face_ids))}")
+    print(f"📁 Known faces loaded: {count_known_faces()}")
+    print(f"👥 Unique workers: {count_known_workers()}")
     print(f"🎯 Match threshold: {CONFIG['FACE_MATCH_THRESHOLD']}")
+    print(f"🧵 Detection workers: {CONFIG['DETECTION_WORKERS']}" + (f" (+{CONFIG['GPU_DETECTION_WORKERS']} GPU)" if gpu_executor is not None else ""))
+    print(f"🖥️  CUDA: {'enabled' if _HAS_CUDA else 'disabled'} (batch detector: {CONFIG['DETECTOR']})")
+    print(f"🌐 Server: {'waitress' if serve is not None else 'Flask development server'}")
     print("\n✅ Ready to accept requests!")
     print("=" * 60)
     
-    # Start Flask app
-    app.run(host=host, port=port, debug=False)
+    # Request threads share state under _lock while detection runs in the
+    # process pool. Keep-alive spares polling clients a TCP handshake per call.
+    if serve is not None:
+        serve(
+            app,
+            host=host,
+            port=port,
+            threads=CONFIG['SERVER_THREADS'],
+            connection_limit=CONFIG['SERVER_CONNECTION_LIMIT']
+        )
+    else:
+        print("⚠️  waitress not installed, falling back to the Flask development server")
+        app.run(host=host, port=port, debug=False, threaded=True)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file